@@ -1,20 +1,25 @@
+import os
 import pandas as pd
 import argparse
 import logging
 
 def check_duplicates(csv_file, id_column='id'):
     """
-    Check for duplicate entries in a CSV file based on a specified column.
+    Check for duplicate entries in a CSV or Parquet file based on a specified column.
 
     Args:
-        csv_file (str): Path to the CSV file.
+        csv_file (str): Path to the CSV or Parquet file.
         id_column (str): The column to check for duplicates. Defaults to 'id'.
     """
-    logging.info(f"Reading CSV file: {csv_file}")
+    logging.info(f"Reading file: {csv_file}")
     try:
-        df = pd.read_csv(csv_file)
+        base_name, extension = os.path.splitext(csv_file)
+        if extension == '.parquet':
+            df = pd.read_parquet(csv_file)
+        else:
+            df = pd.read_csv(csv_file)
         total_rows = len(df)
-        logging.info(f"Total rows in CSV: {total_rows}")
+        logging.info(f"Total rows in file: {total_rows}")
 
         # Check for duplicates
         duplicates = df[df.duplicated(subset=[id_column], keep=False)]
@@ -26,7 +31,7 @@ def check_duplicates(csv_file, id_column='id'):
             logging.warning(f"Number of unique duplicate entries: {num_duplicate_entries}")
 
             # Save duplicates to a separate CSV file for inspection
-            duplicates_file = csv_file.replace('.csv', '_duplicates.csv')
+            duplicates_file = f'{base_name}_duplicates.csv'
             duplicates.to_csv(duplicates_file, index=False)
             logging.info(f"Duplicate rows saved to {duplicates_file}")
         else:
@@ -35,8 +40,8 @@ def check_duplicates(csv_file, id_column='id'):
         logging.error(f"An error occurred while checking for duplicates: {e}")
 
 def main():
-    parser = argparse.ArgumentParser(description='Check for duplicate entries in a CSV file.')
-    parser.add_argument('csv_file', help='Path to the CSV file to check.')
+    parser = argparse.ArgumentParser(description='Check for duplicate entries in a CSV or Parquet file.')
+    parser.add_argument('csv_file', help='Path to the CSV or Parquet file to check.')
     parser.add_argument('--id_column', default='id', help='Column name to check for duplicates (default: id).')
     args = parser.parse_args()
 
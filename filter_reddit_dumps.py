@@ -7,6 +7,7 @@ import logging
 # Import the processing functions
 import filter_reddit_submissions
 import filter_reddit_comments
+from reddit_utils import load_list_from_file, scan_zst_files, scan_completed_outputs
 
 
 def configure_logging(log_file):
@@ -28,7 +29,8 @@ def configure_logging(log_file):
     )
 
 
-def main(dataset_root, output_root, subreddits_file, bot_usernames_file, batch_size=10000):
+def main(dataset_root, output_root, subreddits_file, bot_usernames_file, batch_size=10000, emit_csv=False,
+         parse_workers=0):
     # Create output root directory if it doesn't exist
     os.makedirs(output_root, exist_ok=True)
 
@@ -44,15 +46,16 @@ def main(dataset_root, output_root, subreddits_file, bot_usernames_file, batch_s
     os.makedirs(output_comments_dir, exist_ok=True)
     os.makedirs(output_submissions_dir, exist_ok=True)
 
+    # Load subreddit names and bot usernames once for all files
+    subreddits_set = load_list_from_file(subreddits_file)
+    bot_usernames_set = load_list_from_file(bot_usernames_file)
+
     # Process submissions
     if os.path.exists(submissions_dir):
-        submissions_files = [f for f in os.listdir(submissions_dir) if f.endswith('.zst')]
-        for filename in submissions_files:
-            input_file = os.path.abspath(os.path.join(submissions_dir, filename))
+        completed_outputs = scan_completed_outputs(output_submissions_dir)
+        for input_file, _ in scan_zst_files(submissions_dir):
             base_name = os.path.splitext(os.path.basename(input_file))[0]
-            output_csv_file = os.path.join(output_submissions_dir, f'{base_name}.csv')
             output_parquet_file = os.path.join(output_submissions_dir, f'{base_name}.parquet')
-            stats_output_file = os.path.join(output_submissions_dir, f'{base_name}_stats.txt')
             completion_marker = os.path.join(output_submissions_dir, f'{base_name}_completed.txt')
             log_file = os.path.join(output_submissions_dir, f'{base_name}.log')
 
@@ -61,34 +64,22 @@ def main(dataset_root, output_root, subreddits_file, bot_usernames_file, batch_s
             logging.info(f"Processing submissions file: {input_file}")
             logging.info(f"Log file created at {log_file}")
 
-            # Check if processing is already completed
-            if os.path.exists(completion_marker):
+            # Check if processing is already completed: filter_dump writes the marker once all outputs are
+            # written, so leftover outputs of an interrupted run are redone (completion_marker is from older runs)
+            if os.path.basename(output_parquet_file) in completed_outputs or os.path.exists(completion_marker):
                 logging.info(f"Skipping processing of submissions file {input_file} as it has been marked completed.")
                 continue  # Skip this input file
 
-            # Check if output files exist and are not empty
-            output_files = [output_csv_file, output_parquet_file, stats_output_file]
-            files_exist = all(os.path.isfile(f) and os.path.getsize(f) > 0 for f in output_files)
-
-            if files_exist:
-                logging.info(f"Skipping processing of submissions file {input_file} as output files already exist.")
-                # Optionally, you can create the completion marker if it doesn't exist
-                if not os.path.exists(completion_marker):
-                    with open(completion_marker, 'w') as marker_file:
-                        marker_file.write('Processing completed successfully.')
-                continue  # Skip this input file
-
             try:
-                filter_reddit_submissions.process_submissions(
+                filter_reddit_submissions.run(
                     input_file=input_file,
-                    subreddits_file=os.path.abspath(subreddits_file),
-                    bot_usernames_file=os.path.abspath(bot_usernames_file),
+                    subreddits_set=subreddits_set,
+                    bot_usernames_set=bot_usernames_set,
                     output_directory=output_submissions_dir,
-                    batch_size=batch_size
+                    batch_size=batch_size,
+                    emit_csv=emit_csv,
+                    parse_workers=parse_workers
                 )
-                # Mark processing as completed
-                with open(completion_marker, 'w') as marker_file:
-                    marker_file.write('Processing completed successfully.')
                 logging.info(f"Processing of submissions file {input_file} completed successfully.")
             except Exception as e:
                 logging.error(f"Error processing submissions file {input_file}: {e}", exc_info=True)
@@ -97,13 +88,10 @@ def main(dataset_root, output_root, subreddits_file, bot_usernames_file, batch_s
 
     # Process comments
     if os.path.exists(comments_dir):
-        comments_files = [f for f in os.listdir(comments_dir) if f.endswith('.zst')]
-        for filename in comments_files:
-            input_file = os.path.abspath(os.path.join(comments_dir, filename))
+        completed_outputs = scan_completed_outputs(output_comments_dir)
+        for input_file, _ in scan_zst_files(comments_dir):
             base_name = os.path.splitext(os.path.basename(input_file))[0]
-            output_csv_file = os.path.join(output_comments_dir, f'{base_name}.csv')
             output_parquet_file = os.path.join(output_comments_dir, f'{base_name}.parquet')
-            stats_output_file = os.path.join(output_comments_dir, f'{base_name}_stats.txt')
             completion_marker = os.path.join(output_comments_dir, f'{base_name}_completed.txt')
             log_file = os.path.join(output_comments_dir, f'{base_name}.log')
 
@@ -112,34 +100,22 @@ def main(dataset_root, output_root, subreddits_file, bot_usernames_file, batch_s
             logging.info(f"Processing comments file: {input_file}")
             logging.info(f"Log file created at {log_file}")
 
-            # Check if processing is already completed
-            if os.path.exists(completion_marker):
+            # Check if processing is already completed: filter_dump writes the marker once all outputs are
+            # written, so leftover outputs of an interrupted run are redone (completion_marker is from older runs)
+            if os.path.basename(output_parquet_file) in completed_outputs or os.path.exists(completion_marker):
                 logging.info(f"Skipping processing of comments file {input_file} as it has been marked completed.")
                 continue  # Skip this input file
 
-            # Check if output files exist and are not empty
-            output_files = [output_csv_file, output_parquet_file, stats_output_file]
-            files_exist = all(os.path.isfile(f) and os.path.getsize(f) > 0 for f in output_files)
-
-            if files_exist:
-                logging.info(f"Skipping processing of comments file {input_file} as output files already exist.")
-                # Optionally, you can create the completion marker if it doesn't exist
-                if not os.path.exists(completion_marker):
-                    with open(completion_marker, 'w') as marker_file:
-                        marker_file.write('Processing completed successfully.')
-                continue  # Skip this input file
-
             try:
-                filter_reddit_comments.process_comments(
+                filter_reddit_comments.run(
                     input_file=input_file,
-                    subreddits_file=os.path.abspath(subreddits_file),
-                    bot_usernames_file=os.path.abspath(bot_usernames_file),
+                    subreddits_set=subreddits_set,
+                    bot_usernames_set=bot_usernames_set,
                     output_directory=output_comments_dir,
-                    batch_size=batch_size
+                    batch_size=batch_size,
+                    emit_csv=emit_csv,
+                    parse_workers=parse_workers
                 )
-                # Mark processing as completed
-                with open(completion_marker, 'w') as marker_file:
-                    marker_file.write('Processing completed successfully.')
                 logging.info(f"Processing of comments file {input_file} completed successfully.")
             except Exception as e:
                 logging.error(f"Error processing comments file {input_file}: {e}", exc_info=True)
@@ -154,6 +130,9 @@ if __name__ == '__main__':
     parser.add_argument('subreddits_file', help='Path to the subreddits.txt file')
     parser.add_argument('bot_usernames_file', help='Path to the bot_usernames.txt file')
     parser.add_argument('--batch_size', type=int, default=10000, help='Number of records to process per batch')
+    parser.add_argument('--emit_csv', action='store_true', help='Also write the results to CSV files')
+    parser.add_argument('--parse_workers', type=int, default=0,
+                        help='Number of worker processes parsing and filtering the lines of each file')
 
     args = parser.parse_args()
 
@@ -162,5 +141,7 @@ if __name__ == '__main__':
         output_root=args.output_root,
         subreddits_file=args.subreddits_file,
         bot_usernames_file=args.bot_usernames_file,
-        batch_size=args.batch_size
+        batch_size=args.batch_size,
+        emit_csv=args.emit_csv,
+        parse_workers=args.parse_workers
     )
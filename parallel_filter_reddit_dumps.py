@@ -1,8 +1,20 @@
 import os
+import math
 import argparse
-import subprocess
 import logging
-from concurrent.futures import ProcessPoolExecutor, as_completed
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+from reddit_utils import find_zst_frames, split_zst_ranges, load_list_from_file, scan_zst_files, scan_completed_outputs
+import filter_reddit_submissions
+import filter_reddit_comments
+
+
+# Function that filters each kind of dump file, called directly in the worker processes
+RUN_FUNCTIONS = {
+    'submissions': filter_reddit_submissions.run,
+    'comments': filter_reddit_comments.run,
+}
 
 
 def setup_logging(log_file='processing.log'):
@@ -17,46 +29,133 @@ def setup_logging(log_file='processing.log'):
     )
 
 
-def get_expected_output_files(input_file, output_directory, script_type):
+def get_expected_output_file(input_file, output_directory, script_type, part=None):
     """
-    Determine the expected output files based on the input file and script type.
+    Determine the expected Parquet output file based on the input file and script type.
+    The optional CSV output is not checked: Parquet is the output every run writes.
     """
     base_name = os.path.splitext(os.path.basename(input_file))[0]
-    if script_type == 'comments':
-        output_csv_file = os.path.join(output_directory, f'{base_name}_comments.csv')
-        output_parquet_file = os.path.join(output_directory, f'{base_name}_comments.parquet')
-    elif script_type == 'submissions':
-        output_csv_file = os.path.join(output_directory, f'{base_name}.csv')
-        output_parquet_file = os.path.join(output_directory, f'{base_name}.parquet')
+    if part is not None:
+        base_name = f'{base_name}_part{part:03d}'
+    if script_type in ('comments', 'submissions'):
+        return os.path.join(output_directory, f'{base_name}.parquet')
+    return None
+
+
+def get_file_tasks(input_file, file_size, output_directory, completed_outputs, script_type, ranges_per_file=1,
+                   range_size=None):
+    """
+    Build the pending tasks for one input file.
+    Multi-frame files are split into up to ranges_per_file byte ranges, each processed as a separate part.
+    If range_size is given, the number of ranges follows the file size instead, so that each range
+    holds about range_size compressed bytes.
+    Parts whose Parquet output name is in completed_outputs (see scan_completed_outputs) are skipped.
+    Files whose frames cannot be scanned are processed as a whole, so the error only fails their own task.
+    Each task is (script_type, input_file, output_directory, byte_range, frames, part, size), where frames
+    is the frame list of a split file (passed on so each part does not scan the file again) and size
+    is the number of compressed bytes the task reads.
+    """
+    if range_size:
+        ranges_per_file = max(1, math.ceil(file_size / range_size))
+    frames = None
+    byte_ranges = [None]
+    if ranges_per_file > 1:
+        try:
+            frames = find_zst_frames(input_file)
+            byte_ranges = split_zst_ranges(input_file, ranges_per_file, frames)
+        except (ValueError, OSError) as e:
+            logging.error(f"Could not split {input_file} into byte ranges; processing it as a whole: {e}")
+            frames = None
+    if len(byte_ranges) == 1:
+        frames = None
+        parts = [(None, None)]
     else:
-        output_csv_file = None
-        output_parquet_file = None
-    return output_csv_file, output_parquet_file
+        parts = list(enumerate(byte_ranges))
+
+    tasks = []
+    for part, byte_range in parts:
+        # Determine the expected output file
+        output_parquet_file = get_expected_output_file(input_file, output_directory, script_type, part)
+        # Skip parts whose outputs were completed; a Parquet file without the marker is from an interrupted run
+        if os.path.basename(output_parquet_file) in completed_outputs:
+            logging.info(f"Output files for {input_file} (part {part}) are already complete. Skipping.")
+            continue
+        size = file_size if byte_range is None else byte_range[1] - byte_range[0]
+        tasks.append((script_type, input_file, output_directory, byte_range, frames, part, size))
+    return tasks
+
+
+# Subreddit names and bot usernames of the worker process, loaded once by init_worker
+subreddits_set = None
+bot_usernames_set = None
+
+
+def pin_worker(num_workers):
+    """
+    Pin the current worker process to its own group of the available CPUs (Linux only).
+    Workers are numbered by the pool in start order; each gets a contiguous slice of
+    len(CPUs) // num_workers CPUs, so its decompression thread runs next to its parse loop
+    and its buffers stay on one NUMA node on most machines.
+    """
+    if not hasattr(os, 'sched_setaffinity'):
+        logging.warning("CPU pinning is not supported on this platform; workers are not pinned.")
+        return
+    cpus = sorted(os.sched_getaffinity(0))
+    group_size = max(1, len(cpus) // num_workers)
+    worker_index = int(multiprocessing.current_process().name.rsplit('-', 1)[-1]) - 1
+    start = (worker_index % num_workers) * group_size % len(cpus)
+    worker_cpus = cpus[start:start + group_size]
+    os.sched_setaffinity(0, worker_cpus)
+    logging.debug(f"Pinned worker {worker_index} to CPUs {worker_cpus}")
 
 
-def process_file(script_name, input_file, subreddits_file, bot_usernames_file, output_directory):
-    """Function to process a single file using the specified script."""
+def init_worker(log_file, subreddits_file, bot_usernames_file, pinned_workers=0):
+    """
+    Initialize a worker process.
+    Workers started with fork inherit the logging handlers of the parent; otherwise set them up here.
+    If pinned_workers is set, the worker is pinned to its share of the CPUs among that many workers
+    (see pin_worker) before it allocates anything.
+    The subreddit and bot username lists are loaded here once per worker, so tasks only carry file paths.
+    """
+    global subreddits_set, bot_usernames_set
+    if not logging.getLogger().handlers:
+        setup_logging(log_file)
+    if pinned_workers:
+        pin_worker(pinned_workers)
+    subreddits_set = load_list_from_file(subreddits_file)
+    bot_usernames_set = load_list_from_file(bot_usernames_file)
+
+
+def process_file(script_type, input_file, output_directory, byte_range=None, frames=None, part=None,
+                 partition_root=None, emit_csv=False):
+    """
+    Function to process a single file (or a byte range of it) in the worker process.
+    The filter script is called directly, so each worker imports pyarrow and builds its
+    zstd decompressor once instead of once per file.
+    If partition_root is given, the results are also added to the dataset of this kind of records in it.
+    """
+    partition_directory = os.path.join(partition_root, script_type) if partition_root else None
     try:
-        logging.info(f"Processing file: {input_file} with script: {script_name}")
-        subprocess.run([
-            'python', script_name,
-            input_file,
-            subreddits_file,
-            bot_usernames_file,
-            '--output_directory', output_directory
-        ], check=True)
+        logging.info(f"Processing {script_type} file: {input_file}")
+        RUN_FUNCTIONS[script_type](
+            input_file, subreddits_set, bot_usernames_set,
+            output_directory=output_directory,
+            byte_range=byte_range,
+            frames=frames,
+            part=part,
+            emit_csv=emit_csv,
+            partition_directory=partition_directory
+        )
         logging.info(f"Finished processing file: {input_file}")
-    except subprocess.CalledProcessError as e:
-        logging.error(f"Error processing file: {input_file}")
-        logging.error(e)
-        return False
     except Exception as exc:
         logging.error(f"An unexpected error occurred while processing {input_file}: {exc}")
         return False
     return True
 
 
-def main(dataset_root, output_root, subreddits_file, bot_usernames_file, max_workers=None):
+def main(dataset_root, output_root, subreddits_file, bot_usernames_file, max_workers=None, ranges_per_file=1,
+         log_file='processing.log', range_size=None, partition_root=None, emit_csv=False, pin_workers=False,
+         use_threads=False):
     # Create output root directory if it doesn't exist
     os.makedirs(output_root, exist_ok=True)
 
@@ -75,35 +174,19 @@ def main(dataset_root, output_root, subreddits_file, bot_usernames_file, max_wor
     # Prepare tasks for submissions
     tasks = []
     if os.path.exists(submissions_dir):
-        submissions_files = [f for f in os.listdir(submissions_dir) if f.endswith('.zst')]
-        for filename in submissions_files:
-            input_file = os.path.join(submissions_dir, filename)
-            # Determine expected output files
-            output_csv_file, output_parquet_file = get_expected_output_files(
-                input_file, output_submissions_dir, 'submissions'
-            )
-            # Check if output files exist
-            if os.path.exists(output_csv_file) and os.path.exists(output_parquet_file):
-                logging.info(f"Output files for {input_file} already exist. Skipping.")
-                continue
-            tasks.append(('filter_reddit_submissions.py', input_file, output_submissions_dir))
+        completed_outputs = scan_completed_outputs(output_submissions_dir)
+        for input_file, file_size in scan_zst_files(submissions_dir):
+            tasks += get_file_tasks(input_file, file_size, output_submissions_dir, completed_outputs,
+                                    'submissions', ranges_per_file, range_size)
     else:
         logging.warning(f"Submissions directory not found: {submissions_dir}")
 
     # Prepare tasks for comments
     if os.path.exists(comments_dir):
-        comments_files = [f for f in os.listdir(comments_dir) if f.endswith('.zst')]
-        for filename in comments_files:
-            input_file = os.path.join(comments_dir, filename)
-            # Determine expected output files
-            output_csv_file, output_parquet_file = get_expected_output_files(
-                input_file, output_comments_dir, 'comments'
-            )
-            # Check if output files exist
-            if os.path.exists(output_csv_file) and os.path.exists(output_parquet_file):
-                logging.info(f"Output files for {input_file} already exist. Skipping.")
-                continue
-            tasks.append(('filter_reddit_comments.py', input_file, output_comments_dir))
+        completed_outputs = scan_completed_outputs(output_comments_dir)
+        for input_file, file_size in scan_zst_files(comments_dir):
+            tasks += get_file_tasks(input_file, file_size, output_comments_dir, completed_outputs,
+                                    'comments', ranges_per_file, range_size)
     else:
         logging.warning(f"Comments directory not found: {comments_dir}")
 
@@ -111,22 +194,50 @@ def main(dataset_root, output_root, subreddits_file, bot_usernames_file, max_wor
         logging.info("No tasks to process. All files have been processed or no input files found.")
         return
 
+    # The workers load the lists themselves; fail here rather than in every worker if one is missing
+    for list_file in (subreddits_file, bot_usernames_file):
+        if not os.path.isfile(list_file):
+            raise FileNotFoundError(f"List file not found: {list_file}")
+
+    # Submit the largest tasks first (longest processing time first), so a large file
+    # picked up last does not keep one worker busy while the others sit idle
+    tasks.sort(key=lambda task: task[-1], reverse=True)
+
+    if use_threads:
+        # Threads share this process, so the lists are loaded once here; pinning applies to processes only
+        if pin_workers:
+            logging.warning("--pin_workers is ignored with --use_threads.")
+        init_worker(log_file, subreddits_file, bot_usernames_file)
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+    else:
+        # Pinning splits the CPUs among the workers, so it needs the actual pool size
+        pinned_workers = 0
+        if pin_workers:
+            if max_workers is None:
+                max_workers = os.cpu_count()
+            pinned_workers = max_workers
+        executor = ProcessPoolExecutor(max_workers=max_workers, initializer=init_worker,
+                                       initargs=(log_file, subreddits_file, bot_usernames_file, pinned_workers))
+
     # Process files in parallel
-    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+    with executor:
         future_to_task = {
             executor.submit(
                 process_file,
-                script_name,
+                script_type,
                 input_file,
-                subreddits_file,
-                bot_usernames_file,
-                output_directory
-            ): (script_name, input_file)
-            for script_name, input_file, output_directory in tasks
+                output_directory,
+                byte_range,
+                frames,
+                part,
+                partition_root,
+                emit_csv
+            ): input_file
+            for script_type, input_file, output_directory, byte_range, frames, part, _ in tasks
         }
 
         for future in as_completed(future_to_task):
-            script_name, input_file = future_to_task[future]
+            input_file = future_to_task[future]
             try:
                 result = future.result()
                 if result:
@@ -145,8 +256,27 @@ if __name__ == '__main__':
     parser.add_argument('bot_usernames_file', help='Path to the bot_usernames.txt file')
     parser.add_argument('--max_workers', type=int, default=None, help='Maximum number of worker processes to use')
     parser.add_argument('--log_file', default='processing.log', help='Path to the log file')
+    parser.add_argument('--ranges_per_file', type=int, default=1,
+                        help='Split multi-frame .zst files into up to this many byte ranges processed in parallel')
+    parser.add_argument('--range_size_mb', type=int, default=None,
+                        help='Split multi-frame .zst files into byte ranges of about this many compressed MB '
+                             '(overrides --ranges_per_file)')
+    parser.add_argument('--partition_root',
+                        help='Also write the results to Parquet datasets partitioned by subreddit, '
+                             'in the comments and submissions subdirectories of this directory')
+    parser.add_argument('--emit_csv', action='store_true', help='Also write the results to CSV files')
+    parser.add_argument('--pin_workers', action='store_true',
+                        help='Pin each worker process to its own group of CPUs (Linux only)')
+    parser.add_argument('--use_threads', action='store_true',
+                        help='Process files in threads of this process instead of worker processes; uses less '
+                             'memory, but the line filtering holds the GIL, so it only scales on free-threaded '
+                             'Python builds or when reading is the bottleneck')
 
     args = parser.parse_args()
 
+    range_size = args.range_size_mb * 1024 * 1024 if args.range_size_mb else None
+
     setup_logging(args.log_file)
-    main(args.dataset_root, args.output_root, args.subreddits_file, args.bot_usernames_file, args.max_workers)
+    main(args.dataset_root, args.output_root, args.subreddits_file, args.bot_usernames_file, args.max_workers,
+         args.ranges_per_file, args.log_file, range_size, args.partition_root, args.emit_csv, args.pin_workers,
+         args.use_threads)
@@ -1,27 +1,333 @@
 # reddit_utils.py
 
 import zstandard as zstd
-import io
+import contextlib
+import functools
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
 import os
+import queue
+import threading
+import re
+import sys
 import json
-import pandas as pd
+import orjson
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pcsv
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
 import logging
-import fastparquet
-import csv
 
 
-def read_zst_file(file_path, max_window_size=2147483648):
+# Pushshift dumps are compressed with windows of up to 2 GiB
+MAX_WINDOW_SIZE = 2 ** 31
+
+# Compressed bytes requested from the file per read (4 MiB)
+ZST_READ_SIZE = 1 << 22
+
+# Decompressed bytes handed from the decompression thread to the parser at a time (1 MiB)
+ZST_CHUNK_SIZE = 1 << 20
+
+# Decompressed chunks buffered ahead of the parser
+PREFETCH_CHUNKS = 8
+
+# Suffix of the empty marker file written next to the Parquet output once a file is fully processed
+DONE_SUFFIX = '.done'
+
+# Decompressed bytes of lines handed to a parse worker at a time (64 MiB)
+PARSE_SLAB_SIZE = 1 << 26
+
+# Parquet output compression; zstd level 3 gives smaller files than snappy at similar read speed
+PARQUET_COMPRESSION = 'zstd'
+PARQUET_COMPRESSION_LEVEL = 3
+
+# Buffer in front of the Parquet output file (1 MiB); the writer emits many small pieces (page headers,
+# statistics) per row group, which are otherwise each a separate write call
+PARQUET_BUFFER_SIZE = 1 << 20
+
+# Batches are collected into row groups of up to this many rows or bytes of Arrow data (1 Mi rows, 128 MiB),
+# so that the row groups do not follow the processing batch size
+ROW_GROUP_ROWS = 1 << 20
+ROW_GROUP_BYTES = 1 << 27
+
+
+# Idle decompressors by window size, kept for reuse by borrow_decompressor
+_idle_decompressors = {}
+
+
+@contextlib.contextmanager
+def borrow_decompressor(max_window_size=MAX_WINDOW_SIZE):
     """
-    Generator function to read lines from a .zst compressed file.
+    Context manager lending a ZstdDecompressor for the given window size.
+    Decompressors are returned for reuse across files, so their context is only allocated once
+    per concurrent reader rather than once per file. A decompressor is never lent to two readers
+    at a time: streams read concurrently from one decompressor corrupt each other.
+    """
+    idle = _idle_decompressors.setdefault(max_window_size, [])
+    try:
+        dctx = idle.pop()
+    except IndexError:
+        dctx = zstd.ZstdDecompressor(max_window_size=max_window_size)
+    try:
+        yield dctx
+    finally:
+        idle.append(dctx)
+
+
+# Magic numbers of Zstandard frames and of skippable frames (which carry no data)
+ZST_FRAME_MAGIC = 0xFD2FB528
+ZST_SKIPPABLE_MAGIC_MASK = 0xFFFFFFF0
+ZST_SKIPPABLE_MAGIC = 0x184D2A50
+
+
+def find_zst_frames(file_path):
+    """
+    Return the (offset, size) of each Zstandard frame in a .zst file.
+    Only frame and block headers are read, so the scan is cheap even for large files.
+    Files written by pzstd or by zstd with multiple frames can be split on these boundaries.
+    Raises ValueError if a header is invalid or a frame is cut short by the end of the file.
+    """
+    frames = []
+    file_size = os.path.getsize(file_path)
+    with open(file_path, 'rb') as f:
+        offset = 0
+        while offset < file_size:
+            f.seek(offset)
+            header = f.read(5)
+            if len(header) < 5:
+                raise ValueError(f"Truncated Zstandard frame at offset {offset} in {file_path}")
+            magic = int.from_bytes(header[:4], 'little')
+            if magic & ZST_SKIPPABLE_MAGIC_MASK == ZST_SKIPPABLE_MAGIC:
+                f.seek(offset + 4)
+                size_field = f.read(4)
+                end = offset + 8 + int.from_bytes(size_field, 'little')
+                if len(size_field) < 4 or end > file_size:
+                    raise ValueError(f"Truncated skippable frame at offset {offset} in {file_path}")
+                offset = end
+                continue
+            if magic != ZST_FRAME_MAGIC:
+                raise ValueError(f"Invalid Zstandard frame at offset {offset} in {file_path}")
+
+            # Frame header: descriptor, optional window descriptor, dictionary ID and content size
+            descriptor = header[4]
+            single_segment = (descriptor >> 5) & 1
+            has_checksum = (descriptor >> 2) & 1
+            dictionary_id_size = (0, 1, 2, 4)[descriptor & 3]
+            content_size_size = (single_segment, 2, 4, 8)[descriptor >> 6]
+            position = offset + 5 + (not single_segment) + dictionary_id_size + content_size_size
+
+            # Walk the block headers up to the last block of the frame
+            while True:
+                f.seek(position)
+                block_header = f.read(3)
+                if len(block_header) < 3:
+                    raise ValueError(f"Truncated Zstandard frame at offset {offset} in {file_path}")
+                block_header = int.from_bytes(block_header, 'little')
+                block_type = (block_header >> 1) & 3
+                if block_type == 3:
+                    raise ValueError(f"Invalid Zstandard block at offset {position} in {file_path}")
+                # RLE blocks store a single byte regardless of their decompressed size
+                position += 3 + (1 if block_type == 1 else block_header >> 3)
+                if block_header & 1:
+                    break
+
+            end = position + 4 * has_checksum
+            if end > file_size:
+                raise ValueError(f"Truncated Zstandard frame at offset {offset} in {file_path}")
+            frames.append((offset, end - offset))
+            offset = end
+    return frames
+
+
+def split_zst_ranges(file_path, num_ranges, frames=None):
+    """
+    Group the frames of a .zst file into at most num_ranges contiguous byte ranges of similar size.
+    Returns a list of (start, end) offsets; single-frame files always yield a single range.
+    frames is the result of find_zst_frames for the file, if the caller already has it.
+    """
+    if frames is None:
+        frames = find_zst_frames(file_path)
+    if not frames:
+        return [(0, os.path.getsize(file_path))]
+
+    target_size = sum(size for _, size in frames) / num_ranges
+    ranges = []
+    start, consumed = frames[0][0], 0
+    for offset, size in frames:
+        # Start a new range at the first frame past the next multiple of the target size
+        if offset > start and consumed >= target_size * (len(ranges) + 1):
+            ranges.append((start, offset))
+            start = offset
+        consumed += size
+    last_offset, last_size = frames[-1]
+    ranges.append((start, last_offset + last_size))
+    return ranges
+
+
+class _ProducerError:
+    """
+    Wraps an exception raised in a prefetch thread so the consumer can re-raise it.
+    """
+    def __init__(self, error):
+        self.error = error
+
+
+def prefetch(iterable, max_pending=PREFETCH_CHUNKS):
+    """
+    Generator function that consumes iterable in a background thread.
+    Up to max_pending items are buffered, so producing the next items (zstd decompression,
+    which releases the GIL) overlaps with processing the current one in the calling thread.
+    """
+    items = queue.Queue(maxsize=max_pending)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        # Give up if the consumer has stopped, instead of blocking on a full queue forever
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+            put(done)
+        except BaseException as e:
+            put(_ProducerError(e))
+        finally:
+            if hasattr(iterable, 'close'):
+                iterable.close()
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = items.get()
+            if item is done:
+                break
+            if isinstance(item, _ProducerError):
+                raise item.error
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+def split_lines(chunks):
+    """
+    Generator function to split a stream of byte chunks into lines.
+    Lines are not stripped: JSON parsers ignore surrounding whitespace, and Windows line endings
+    are handled once per chunk instead of once per line.
+    """
+    pending = b''
+    for chunk in chunks:
+        data = pending + chunk
+        if b'\r' in data:
+            data = data.replace(b'\r\n', b'\n')
+        lines = data.split(b'\n')
+        pending = lines.pop()
+        yield from lines
+    if pending:
+        yield pending.rstrip(b'\r')
+
+
+def read_zst_chunks(file_path, max_window_size=MAX_WINDOW_SIZE, read_size=ZST_READ_SIZE,
+                    chunk_size=ZST_CHUNK_SIZE):
+    """
+    Generator function to read the decompressed content of a .zst file in chunks.
+    Chunks are not aligned on line boundaries.
+    ZstdDecompressor.read_to_iter is not used here: it stops at the end of the first frame,
+    which would silently truncate multi-frame files, and it was no faster than stream_reader.
+    """
+    with borrow_decompressor(max_window_size) as dctx, open(file_path, 'rb') as f:
+        with dctx.stream_reader(f, read_size=read_size, read_across_frames=True) as reader:
+            while True:
+                chunk = reader.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+
+
+def _iter_frame_chunks(f, frames, dctx, read_size):
+    """
+    Generator function to decompress the given frames of an open .zst file chunk by chunk.
+    """
+    for offset, size in frames:
+        dobj = dctx.decompressobj()
+        f.seek(offset)
+        remaining = size
+        while remaining > 0:
+            chunk = f.read(min(read_size, remaining))
+            if not chunk:
+                raise EOFError(f"Unexpected end of file in frame at offset {offset}")
+            remaining -= len(chunk)
+            data = dobj.decompress(chunk)
+            if data:
+                yield data
+
+
+def _read_zst_range(file_path, byte_range, max_window_size, read_size, frames=None):
+    """
+    Generator function to read the decompressed data that belongs to a byte range of a
+    multi-frame .zst file, in chunks that are not aligned on line boundaries.
+
+    Frame boundaries do not line up with line boundaries, so a line that straddles two
+    ranges belongs to the earlier one: each range skips everything up to its first newline,
+    and reads into the following frames to finish its last line.
+    frames is the result of find_zst_frames for the file; the file is scanned if it is not given.
+    """
+    start, end = byte_range
+    if frames is None:
+        frames = find_zst_frames(file_path)
+    range_frames = [frame for frame in frames if start <= frame[0] < end]
+    following_frames = [frame for frame in frames if frame[0] >= end]
+    skipping = any(offset < start for offset, _ in frames)
+
+    with borrow_decompressor(max_window_size) as dctx, open(file_path, 'rb') as f:
+        for chunk in _iter_frame_chunks(f, range_frames, dctx, read_size):
+            if skipping:
+                newline = chunk.find(b'\n')
+                if newline < 0:
+                    continue
+                chunk = chunk[newline + 1:]
+                skipping = False
+            if chunk:
+                yield chunk
+
+        if skipping:
+            # No line starts in this range; it is read by the previous range
+            return
+
+        # Finish the line that straddles the end of the range, newline included
+        for chunk in _iter_frame_chunks(f, following_frames, dctx, read_size):
+            newline = chunk.find(b'\n')
+            if newline >= 0:
+                yield chunk[:newline + 1]
+                break
+            yield chunk
+
+
+def read_zst_data(file_path, max_window_size=MAX_WINDOW_SIZE, read_size=ZST_READ_SIZE, byte_range=None,
+                  chunk_size=ZST_CHUNK_SIZE, frames=None):
+    """
+    Generator function to read the decompressed content of a .zst file in chunks that are not
+    aligned on line boundaries (see read_zst_file for the arguments).
+    Decompression runs in a background thread (see prefetch), overlapping with the caller's work.
     """
     logging.debug(f"Reading .zst file: {file_path}")
     try:
-        with open(file_path, 'rb') as f:
-            dctx = zstd.ZstdDecompressor(max_window_size=max_window_size)
-            with dctx.stream_reader(f) as reader:
-                text_stream = io.TextIOWrapper(reader, encoding='utf-8')
-                for line in text_stream:
-                    yield line.strip()
+        if byte_range is not None:
+            chunks = _read_zst_range(file_path, byte_range, max_window_size, read_size, frames)
+        else:
+            chunks = read_zst_chunks(file_path, max_window_size, read_size, chunk_size)
+        yield from prefetch(chunks)
     except zstd.ZstdError as e:
         logging.error(f"Zstd decompression error: {e}")
         raise
@@ -30,56 +336,699 @@ def read_zst_file(file_path, max_window_size=2147483648):
         raise
 
 
+def read_zst_file(file_path, max_window_size=MAX_WINDOW_SIZE, read_size=ZST_READ_SIZE, byte_range=None,
+                  chunk_size=ZST_CHUNK_SIZE, frames=None):
+    """
+    Generator function to read lines from a .zst compressed file.
+    Lines are yielded as bytes, without decoding, since JSON parsers accept UTF-8 bytes directly.
+    Decompression runs in a background thread (see prefetch), overlapping with the caller's parsing.
+    If byte_range is given as (start, end) compressed offsets, only the lines that belong to
+    the frames within that range are read (see split_zst_ranges); frames can pass in the frame list
+    of the file (see find_zst_frames), so that callers splitting the file do not scan it again per range.
+    read_size (compressed bytes per file read) and chunk_size (decompressed bytes per chunk handed
+    to the line splitter) can be tuned to the storage.
+    """
+    return split_lines(read_zst_data(file_path, max_window_size, read_size, byte_range, chunk_size, frames))
+
 
 def load_list_from_file(file_path):
     """
     Load items from a text file.
     Each line in the file should contain one item.
+    Items are lowercased and interned, so lookups of equal interned strings hit the identity fast path.
+    Returns a frozenset, since the lists are only used for membership tests.
     """
     items = set()
     with open(file_path, 'r', encoding='utf-8') as f:
         for line in f:
             item = line.strip()
             if item:
-                items.add(item.lower())
+                items.add(sys.intern(item.lower()))
     logging.debug(f"Loaded {len(items)} items from {file_path}")
-    return items
+    return frozenset(items)
 
 
-def write_batch_to_disk(df_batch, output_csv_file, output_parquet_file, header_written):
+def scan_zst_files(directory):
     """
-    Write a batch of data to CSV and Parquet files.
+    List the .zst files in a directory as (path, compressed size) pairs, in a single directory scan.
     """
-    logging.debug(f"Writing batch of size {len(df_batch)} to {output_csv_file} and {output_parquet_file}")
+    with os.scandir(directory) as entries:
+        return [(entry.path, entry.stat().st_size) for entry in entries
+                if entry.name.endswith('.zst') and entry.is_file()]
 
-    # Save to CSV in append mode
-    df_batch.to_csv(
-        output_csv_file,
-        mode='a',
-        index=False,
-        header=not header_written,
-        lineterminator='\n',
-        quoting=csv.QUOTE_MINIMAL,
-        encoding='utf-8'
-    )
 
-    # Update the header_written flag
-    header_written = True
+def scan_completed_outputs(directory):
+    """
+    Return the names of the Parquet outputs in a directory that filter_dump marked complete (see DONE_SUFFIX).
+    A single directory scan answers the skip check for every input file, instead of one stat call per file.
+    """
+    with os.scandir(directory) as entries:
+        return {entry.name[:-len(DONE_SUFFIX)] for entry in entries if entry.name.endswith(DONE_SUFFIX)}
+
+
+# Raw "subreddit": "<name>" pairs of an NDJSON line. Keys inside string values never match,
+# since their quotes are escaped.
+SUBREDDIT_PATTERN = re.compile(rb'"subreddit"\s*:\s*"((?:[^"\\]|\\.)*)"')
+
+# Byte-level translation table for lowercasing ASCII names without decoding them
+ASCII_LOWER = bytes.maketrans(b'ABCDEFGHIJKLMNOPQRSTUVWXYZ', b'abcdefghijklmnopqrstuvwxyz')
+
+
+def match_subreddit(line):
+    """
+    Extract the lowercased subreddit name from a raw NDJSON line without parsing it.
+    The name is returned as bytes, so the lines rejected here are never decoded.
+    Returns None when the line does not hold exactly one plain ASCII "subreddit" field (e.g.
+    crossposts that embed their parent submission), in which case the line has to be parsed to tell.
+    """
+    matches = SUBREDDIT_PATTERN.findall(line)
+    if len(matches) != 1:
+        return None
+    name = matches[0]
+    if b'\\' in name or not name.isascii():
+        return None
+    return name.translate(ASCII_LOWER)
 
-    # Save to Parquet using fastparquet
-    if not os.path.exists(output_parquet_file):
-        df_batch.to_parquet(
-            output_parquet_file,
-            index=False,
-            compression='snappy',
-            engine='fastparquet'
+
+def merge_counts(counts):
+    """
+    Merge counts keyed by raw bytes (from match_subreddit) into the counts of the decoded keys.
+    Keys keep the order in which they were first counted.
+    """
+    merged = {}
+    for key, count in counts.items():
+        if isinstance(key, bytes):
+            key = key.decode('utf-8', errors='replace')
+        merged[key] = merged.get(key, 0) + count
+    return merged
+
+
+def make_row_appender(fields):
+    """
+    Create one column list per field and a function that appends a parsed record to them.
+    The function is generated with one inlined append per field, so collecting a row does not
+    run a Python-level loop over the fields. Returns (columns, append_row).
+    """
+    columns = [[] for _ in fields]
+    namespace = {f'append_{index}': column.append for index, column in enumerate(columns)}
+    source = ['def append_row(obj):', '    get = obj.get']
+    source += [f'    append_{index}(get({field!r}))' for index, field in enumerate(fields)]
+    exec('\n'.join(source), namespace)
+    return columns, namespace['append_row']
+
+
+# Author name of records whose account was deleted
+DELETED_AUTHOR = '[deleted]'
+
+
+@functools.lru_cache(maxsize=None)
+def make_row_filter(rejects):
+    """
+    Create the function that applies the per-row filters to a parsed record.
+
+    Args:
+        rejects (tuple): (filter name, field, test) tuples in reporting order, where test is an
+            expression template such as '{} is not None' applied to the field value.
+
+    The generated filter_row(obj, bot_usernames_set) returns 'bots' for bot and deleted authors,
+    otherwise the name of the first filter whose test holds, or None if the row is kept.
+    Most rows pass every filter, so all tests are fused into one short-circuit expression and the
+    rejecting filter is only looked for when it fails.
+    """
+    tests = [test.format(f'get({field!r})') for _, field, test in rejects]
+    source = [
+        'def filter_row(obj, bot_usernames_set):',
+        '    get = obj.get',
+        "    author = get('author', '').lower()",
+        '    if author in bot_usernames_set or author == DELETED_AUTHOR:',
+        "        return 'bots'",
+        '    if (' + '\n            or '.join(tests) + '):',
+    ]
+    for (name, _, _), test in zip(rejects, tests):
+        source += [f'        if {test}:', f'            return {name!r}']
+    source.append('    return None')
+    namespace = {'DELETED_AUTHOR': DELETED_AUTHOR}
+    exec('\n'.join(source), namespace)
+    return namespace['filter_row']
+
+
+def _coerce_value(value, arrow_type):
+    """
+    Coerce a single value to the Python type expected by arrow_type.
+    Returns None if the value cannot be converted, or does not fit a narrow integer type.
+    """
+    if value is None:
+        return None
+    try:
+        if pa.types.is_boolean(arrow_type):
+            return value if isinstance(value, bool) else None
+        if pa.types.is_integer(arrow_type):
+            value = int(float(value))
+            bound = 1 << (arrow_type.bit_width - 1)
+            return value if -bound <= value < bound else None
+        if pa.types.is_timestamp(arrow_type):
+            return int(float(value))
+        if pa.types.is_floating(arrow_type):
+            return float(value)
+        if pa.types.is_string(arrow_type):
+            return str(value)
+    except (TypeError, ValueError, OverflowError):
+        return None
+    return value
+
+
+def to_arrow_array(values, arrow_type, column=None):
+    """
+    Convert a list of values to an Arrow array of the given type.
+    Values that cannot be converted are stored as nulls.
+    """
+    try:
+        return pa.array(values, type=arrow_type)
+    except (pa.ArrowInvalid, pa.ArrowTypeError, TypeError, ValueError, OverflowError):
+        pass
+
+    # Fall back to converting value by value
+    array = pa.array([_coerce_value(value, arrow_type) for value in values], type=arrow_type)
+    num_failed_conversion = array.null_count - sum(value is None for value in values)
+    if num_failed_conversion > 0:
+        logging.warning(f"{num_failed_conversion} values in '{column}' could not be converted to {arrow_type}.")
+    return array
+
+
+def serialize_json_column(values):
+    """
+    Serialize a column of nested objects to JSON strings. Empty values become 'null'.
+    Only kept rows reach this point, so re-serializing with orjson costs little next to parsing
+    the lines; returning bytes and casting them to strings in Arrow measured slower.
+    Integers wider than 64 bits were already turned into floats by orjson.loads, so they are
+    written as floats (e.g. 1.1805916207174113e21) rather than as the exact digits of the dump.
+    """
+    try:
+        return [orjson.dumps(x).decode() if x else 'null' for x in values]
+    except orjson.JSONEncodeError:
+        # Values nested deeper than the orjson encoder's limit (255 levels), which orjson.loads accepts
+        return [json.dumps(x) if x else 'null' for x in values]
+
+
+def build_record_batch(columns, schema, json_columns=(), text_columns=(), fill_values=None):
+    """
+    Build a pyarrow RecordBatch conforming to schema from one list of values per schema field.
+
+    Args:
+        columns (list): Lists of column values, in the order of the schema fields.
+        schema (pa.Schema): Output schema; drives the type conversions.
+        json_columns (list): Columns holding nested objects, serialized to JSON strings.
+        text_columns (list): Columns whose newline characters are replaced with spaces.
+        fill_values (dict): Replacement values for missing entries, keyed by column.
+    """
+    fill_values = fill_values or {}
+    arrays = []
+    for field, values in zip(schema, columns):
+        if field.name in json_columns:
+            values = serialize_json_column(values)
+        array = to_arrow_array(values, field.type, field.name)
+        if field.name in text_columns:
+            array = pc.replace_substring(array, pattern='\n', replacement=' ')
+            array = pc.replace_substring(array, pattern='\r', replacement=' ')
+        if field.name in fill_values:
+            array = pc.fill_null(array, fill_values[field.name])
+        arrays.append(array)
+
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+class BatchWriter:
+    """
+    Writer for the record batches of one output file.
+    The Parquet file and the optional CSV file are held open until the writer is closed, so each
+    batch is appended without reopening the CSV file or tracking whether its header was written.
+
+    Batches are collected until they reach row_group_rows rows or row_group_bytes bytes and then
+    written together, as one Parquet row group (and one set of dataset files).
+
+    Used as a context manager, the writer is closed on exit; if an exception was raised, the
+    incomplete Parquet and CSV files, and the dataset files written so far, are removed so that
+    the file is processed again on the next run.
+
+    If partition_directory is given, the batches are also added to a Parquet dataset partitioned
+    by subreddit (partition_directory/subreddit=<name>/). Its files are named after
+    partition_basename, which must be unique per writer, so several processes can write to the
+    same dataset at once. Unlike the Parquet file, the dataset has no completion marker, and a
+    rerun only replaces dataset files with the same names: the files of a killed run stay behind,
+    as do those of a rerun with a different byte-range split, so the dataset should be rebuilt
+    from an empty directory after an interrupted run.
+    """
+
+    def __init__(self, output_parquet_file, schema, output_csv_file=None, compression=PARQUET_COMPRESSION,
+                 compression_level=PARQUET_COMPRESSION_LEVEL, use_dictionary=True, partition_directory=None,
+                 partition_basename=None, row_group_rows=ROW_GROUP_ROWS, row_group_bytes=ROW_GROUP_BYTES):
+        self.output_files = [output_parquet_file] + ([output_csv_file] if output_csv_file is not None else [])
+        self.parquet_stream = pa.output_stream(output_parquet_file, buffer_size=PARQUET_BUFFER_SIZE)
+        self.csv_writer = None
+        try:
+            self.parquet_writer = pq.ParquetWriter(
+                self.parquet_stream, schema,
+                compression=compression,
+                compression_level=compression_level,
+                use_dictionary=use_dictionary,
+                write_statistics=True
+            )
+            if output_csv_file is not None:
+                try:
+                    self.csv_writer = pcsv.CSVWriter(output_csv_file, schema,
+                                                     write_options=pcsv.WriteOptions(quoting_style='needed'))
+                except Exception:
+                    self.parquet_writer.close()
+                    raise
+        except Exception:
+            self.parquet_stream.close()
+            raise
+
+        self.partition_directory = partition_directory
+        self.partition_basename = partition_basename
+        self.partition_format = ds.ParquetFileFormat()
+        self.partition_options = self.partition_format.make_write_options(
+            compression=compression,
+            compression_level=compression_level,
+            use_dictionary=use_dictionary,
+            write_statistics=True
         )
+        self.row_group_rows = row_group_rows
+        self.row_group_bytes = row_group_bytes
+        self.pending_batches = []
+        self.pending_rows = 0
+        self.pending_bytes = 0
+        self.row_groups_written = 0
+        # Paths of the dataset files written so far, removed again by discard
+        self.partition_files = []
+
+    def write(self, record_batch):
+        """
+        Add a batch of data, writing the collected batches once they fill a row group.
+        """
+        if record_batch.num_rows == 0:
+            return
+        self.pending_batches.append(record_batch)
+        self.pending_rows += record_batch.num_rows
+        self.pending_bytes += record_batch.nbytes
+        if self.pending_rows >= self.row_group_rows or self.pending_bytes >= self.row_group_bytes:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the collected batches to the Parquet file as one row group and, if enabled, to the CSV file
+        and the partitioned dataset.
+        """
+        if not self.pending_batches:
+            return
+        table = pa.Table.from_batches(self.pending_batches)
+        self.pending_batches = []
+        self.pending_rows = 0
+        self.pending_bytes = 0
+
+        logging.debug(f"Writing row group of {table.num_rows} rows to {self.output_files[0]}")
+        self.parquet_writer.write_table(table, row_group_size=table.num_rows)
+        if self.csv_writer is not None:
+            self.csv_writer.write_table(table)
+        if self.partition_directory is not None:
+            ds.write_dataset(
+                table, self.partition_directory,
+                format=self.partition_format,
+                file_options=self.partition_options,
+                partitioning=['subreddit'],
+                partitioning_flavor='hive',
+                basename_template=f'{self.partition_basename}-{self.row_groups_written}-{{i}}.parquet',
+                existing_data_behavior='overwrite_or_ignore',
+                file_visitor=lambda written_file: self.partition_files.append(written_file.path)
+            )
+        self.row_groups_written += 1
+
+    def close(self):
+        # Every resource is closed even if flushing or closing another one fails (callbacks run in reverse order)
+        with contextlib.ExitStack() as stack:
+            if self.csv_writer is not None:
+                stack.callback(self.csv_writer.close)
+            # The writer does not close a stream it was given, so the buffered stream is closed here
+            stack.callback(self.parquet_stream.close)
+            stack.callback(self.parquet_writer.close)
+            self.flush()
+
+    def discard(self):
+        """
+        Close the writer and remove its incomplete output files.
+        The collected batches are dropped rather than written. Errors while closing are only logged,
+        so the files are always removed and the exception that led here is the one that propagates.
+        """
+        self.pending_batches = []
+        try:
+            self.close()
+        except Exception as e:
+            logging.error(f"Error while closing incomplete output files: {e}")
+        for output_file in self.output_files + self.partition_files:
+            if os.path.exists(output_file):
+                os.remove(output_file)
+        logging.warning(f"Removed incomplete output files: {', '.join(self.output_files)}")
+        if self.partition_files:
+            logging.warning(f"Removed {len(self.partition_files)} dataset files written for "
+                            f"{self.partition_basename} from {self.partition_directory}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            try:
+                self.close()
+            except Exception:
+                # e.g. the disk filled up while writing the last row group
+                self.discard()
+                raise
+        else:
+            self.discard()
+
+
+# Everything that differs between filtering submissions and comments:
+#   name: kind of records, used in the log messages
+#   schema: output schema; its field names are the fields kept for each record
+#   dictionary_columns: fields dictionary-encoded in the Parquet output
+#   filter_names: names of the per-row filters, in the order they are reported
+#   rejects: per-row filters, compiled into a filter_row function by make_row_filter
+#   process_data: function(columns) building a RecordBatch from the column buffers
+# Modes only hold plain data and module-level functions, so they can be sent to parse workers.
+FilterMode = namedtuple('FilterMode', ['name', 'schema', 'dictionary_columns', 'filter_names',
+                                       'rejects', 'process_data'])
+
+
+def filter_dump(mode, input_file, subreddits_set, bot_usernames_set, output_directory=None, batch_size=10000,
+                byte_range=None, part=None, emit_csv=False, partition_directory=None, parse_workers=0, frames=None):
+    """
+    Filter a .zst dump file of submissions or comments, as described by mode (a FilterMode).
+    subreddits_set and bot_usernames_set are the lowercased names loaded by load_list_from_file.
+    Records from the subreddits of interest that pass the filters are written to Parquet
+    (and optionally CSV and a dataset partitioned by subreddit, see BatchWriter) in batches,
+    and the filtering counts to a stats file.
+    Once everything is written, an empty marker file (the Parquet path plus DONE_SUFFIX) records that
+    the outputs are complete, so drivers can skip the file on the next run with a single check.
+    frames optionally passes the frame list of the input file along with byte_range (see read_zst_file).
+    With parse_workers > 0, the lines are parsed and filtered in that many worker processes
+    (see filter_batches_in_workers) while this process decompresses and writes.
+    """
+    logging.info(f"Processing {mode.name} file: {input_file}")
+
+    # Determine the output directory
+    if output_directory is None:
+        output_directory = os.getcwd()
     else:
-        fastparquet.write(
-            output_parquet_file,
-            df_batch,
-            compression='snappy',
-            append=True
-        )
+        os.makedirs(output_directory, exist_ok=True)
+
+    # Derive output filenames from the input .zst filename
+    base_name = os.path.splitext(os.path.basename(input_file))[0]
+    if part is not None:
+        base_name = f'{base_name}_part{part:03d}'
+    output_csv_file = os.path.join(output_directory, f'{base_name}.csv') if emit_csv else None
+    output_parquet_file = os.path.join(output_directory, f'{base_name}.parquet')
+    stats_output_file = os.path.join(output_directory, f'{base_name}_stats.json')
+    counts_output_file = os.path.join(output_directory, f'{base_name}_subreddit_counts.parquet')
+    done_file = output_parquet_file + DONE_SUFFIX
+
+    # The outputs are about to be rewritten, so a marker from an earlier run no longer holds
+    if os.path.exists(done_file):
+        os.remove(done_file)
+
+    counts = new_filter_counts(mode)
+    total_filtered = 0
+    total_processed = 0
+    total_written = 0
+
+    with BatchWriter(output_parquet_file, mode.schema, output_csv_file,
+                     use_dictionary=mode.dictionary_columns,
+                     partition_directory=partition_directory,
+                     partition_basename=base_name) as batch_writer:
+        if parse_workers > 0:
+            chunks = read_zst_data(input_file, byte_range=byte_range, frames=frames)
+            batches = filter_batches_in_workers(mode, chunks, subreddits_set, bot_usernames_set, counts,
+                                                parse_workers)
+        else:
+            lines = read_zst_file(input_file, byte_range=byte_range, frames=frames)
+            batches = filter_batches(mode, lines, subreddits_set, bot_usernames_set, counts, batch_size)
+
+        for record_batch, rows_before_processing in batches:
+            rows_after_processing = record_batch.num_rows
+            batch_writer.write(record_batch)
+
+            # Update counts
+            total_processed += rows_after_processing
+            total_filtered += rows_before_processing - rows_after_processing
+            total_written += rows_after_processing
+
+            logging.debug(f"Processed batch of size {rows_after_processing}. Total written so far: {total_written}")
+
+    # Final counts
+    total_lines = counts['lines']
+    logging.info(f"Total lines read: {total_lines}")
+    logging.info(f"Total lines processed: {total_processed}")
+    logging.info(f"Total lines filtered: {total_filtered}")
+    logging.info(f"Total lines written: {total_written}")
+
+    # Save counts to the stats files
+    totals = {
+        'lines_read': total_lines,
+        'lines_processed': total_processed,
+        'lines_kept': total_written,
+        'lines_filtered': total_filtered,
+    }
+    write_stats(stats_output_file, counts_output_file, totals, counts['filtered_counts'],
+                merge_counts(counts['subreddit_counts']), counts['filtered_subreddit_counts'])
+
+    # Mark the outputs as complete; outputs without the marker are left over from an interrupted run
+    open(done_file, 'wb').close()
+
+    if emit_csv:
+        logging.info(f"Data saved to {output_csv_file} and {output_parquet_file}")
+    else:
+        logging.info(f"Data saved to {output_parquet_file}")
+
+
+def new_filter_counts(mode):
+    """
+    Return the empty counts updated by filter_batches: lines read, lines rejected per filter,
+    and lines per subreddit (all lines, and lines from the subreddits of interest).
+    """
+    return {
+        'lines': 0,
+        'filtered_counts': dict.fromkeys(('not_interest_subreddit', 'bad_lines', 'bots') + mode.filter_names, 0),
+        'subreddit_counts': {},
+        'filtered_subreddit_counts': {},
+    }
+
+
+def add_filter_counts(counts, other):
+    """
+    Add the counts of a later part of the same file to counts.
+    Subreddits keep the order in which they were first counted.
+    """
+    counts['lines'] += other['lines']
+    for key in ('filtered_counts', 'subreddit_counts', 'filtered_subreddit_counts'):
+        target = counts[key]
+        for name, count in other[key].items():
+            target[name] = target.get(name, 0) + count
+
+
+def filter_batches(mode, lines, subreddits_set, bot_usernames_set, counts, batch_size, decode_errors=None):
+    """
+    Generator function to filter raw NDJSON lines into batches of records.
+    Yields (record_batch, rows_before_processing) for every batch_size kept rows and for the
+    remaining rows at the end, and updates counts (see new_filter_counts) along the way.
+    Lines that are not valid JSON are logged, or appended to decode_errors as
+    (line number, message) if a list is given.
+    """
+    # Encoded subreddit names, matched against the raw lines by the prefilter, mapped to the names
+    subreddit_keys = {subreddit.encode('utf-8'): subreddit for subreddit in subreddits_set}
+
+    # One list per output field, reused for every batch
+    columns, append_row = make_row_appender(mode.schema.names)
+    filtered_counts = counts['filtered_counts']
+    subreddit_counts = counts['subreddit_counts']
+    filtered_subreddit_counts = counts['filtered_subreddit_counts']
+
+    # Bind the callables used on every line to locals, saving the global and attribute lookups
+    loads = orjson.loads
+    match = match_subreddit
+    filter_row = make_row_filter(mode.rejects)
+
+    line_number = 0
+    for line in lines:
+        line_number += 1
+        if not line:
+            filtered_counts['bad_lines'] += 1
+            continue
+
+        # Reject lines from other subreddits before paying for a full JSON parse;
+        # their counts stay keyed by the raw name until the stats are written.
+        # The match is only used to reject: it cannot tell the top-level field from a nested one
+        # (e.g. in crosspost_parent_list), so kept lines take their subreddit from the parsed record
+        subreddit_key = match(line)
+        if subreddit_key is not None and subreddit_key not in subreddit_keys:
+            subreddit_counts[subreddit_key] = subreddit_counts.get(subreddit_key, 0) + 1
+            filtered_counts['not_interest_subreddit'] += 1
+            continue
+
+        try:
+            obj = loads(line)
+            subreddit = obj.get('subreddit', '').lower()
+            subreddit_counts[subreddit] = subreddit_counts.get(subreddit, 0) + 1
+
+            if subreddit not in subreddits_set:
+                filtered_counts['not_interest_subreddit'] += 1
+                continue
+
+            filtered_subreddit_counts[subreddit] = filtered_subreddit_counts.get(subreddit, 0) + 1
+
+            reason = filter_row(obj, bot_usernames_set)
+            if reason is not None:
+                filtered_counts[reason] += 1
+                continue
+
+            # Collect relevant fields
+            append_row(obj)
+
+            if len(columns[0]) >= batch_size:
+                yield flush_batch(columns, mode.process_data)
+
+        except orjson.JSONDecodeError as e:
+            filtered_counts['bad_lines'] += 1
+            if decode_errors is None:
+                logging.error(f"JSON decode error at line {line_number}: {e}")
+            else:
+                decode_errors.append((line_number, str(e)))
+            continue  # Skip lines that cannot be parsed
+
+    counts['lines'] += line_number
+
+    # Process any remaining data
+    if columns[0]:
+        yield flush_batch(columns, mode.process_data)
+
+
+def flush_batch(columns, process_data):
+    """
+    Process the collected rows into a RecordBatch and clear the column buffers.
+    Used for both full batches and the remaining rows at the end of the file.
+    Returns the RecordBatch and the number of rows collected before processing.
+    """
+    rows_before_processing = len(columns[0])
+
+    # Apply data processing steps
+    record_batch = process_data(columns)
+
+    for column in columns:
+        column.clear()
+
+    return record_batch, rows_before_processing
+
+
+def iter_slabs(chunks, slab_size=PARSE_SLAB_SIZE):
+    """
+    Generator function to group decompressed chunks into slabs of about slab_size bytes.
+    Every slab but the last ends with a newline: the data after the last newline is carried
+    into the next slab, so no line is split between two slabs and split_lines([slab]) gives
+    back the lines of the slab. Lines are never looked at one by one here.
+    """
+    parts = []
+    size = 0
+    for chunk in chunks:
+        size += len(chunk)
+        newline = chunk.rfind(b'\n') if size >= slab_size else -1
+        if newline < 0:
+            # Below the slab size, or no line ends in this chunk yet
+            parts.append(chunk)
+            continue
+        # Cut in the chunk itself, so the slab is copied once by the join
+        parts.append(chunk[:newline + 1])
+        yield b''.join(parts)
+        parts = [chunk[newline + 1:]]
+        size = len(parts[0])
+    data = b''.join(parts)
+    if data:
+        yield data
+
+
+# Arguments shared by every slab of a parse worker, set once by _init_parse_worker
+_parse_worker_args = None
+
+
+def _init_parse_worker(mode, subreddits_set, bot_usernames_set):
+    global _parse_worker_args
+    _parse_worker_args = (mode, subreddits_set, bot_usernames_set)
+
+
+def _filter_slab(slab):
+    """
+    Split one slab into lines and filter them in a parse worker.
+    Returns the list of (record_batch, rows_before_processing), the counts of the slab, and the
+    JSON decode errors as (line number within the slab, message).
+    """
+    mode, subreddits_set, bot_usernames_set = _parse_worker_args
+    counts = new_filter_counts(mode)
+    decode_errors = []
+    batches = list(filter_batches(mode, split_lines([slab]), subreddits_set, bot_usernames_set, counts,
+                                  float('inf'), decode_errors))
+    return batches, counts, decode_errors
+
+
+def filter_batches_in_workers(mode, chunks, subreddits_set, bot_usernames_set, counts, parse_workers):
+    """
+    Generator function with the same output as filter_batches, with the splitting into lines,
+    parsing and filtering spread over parse_workers processes.
+    The decompressed chunks (see read_zst_data) are sent to the workers in slabs (see iter_slabs),
+    and each slab comes back as one batch.
+    Results are collected in submission order, so rows and counts keep the order of the file, and
+    at most two slabs per worker are in flight at a time.
+    """
+    def collect(future):
+        batches, slab_counts, decode_errors = future.result()
+        # Lines are counted by the workers, so line numbers are made absolute as the slabs come back in order
+        for line_number, error in decode_errors:
+            logging.error(f"JSON decode error at line {counts['lines'] + line_number}: {error}")
+        add_filter_counts(counts, slab_counts)
+        return batches
+
+    with ProcessPoolExecutor(max_workers=parse_workers, initializer=_init_parse_worker,
+                             initargs=(mode, subreddits_set, bot_usernames_set)) as executor:
+        pending = deque()
+        try:
+            for slab in iter_slabs(chunks):
+                pending.append(executor.submit(_filter_slab, slab))
+                if len(pending) >= 2 * parse_workers:
+                    yield from collect(pending.popleft())
+
+            while pending:
+                yield from collect(pending.popleft())
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def write_stats(stats_output_file, counts_output_file, totals, filtered_counts, subreddit_counts,
+                filtered_subreddit_counts):
+    """
+    Save the counts of a processed file.
+    The totals and per-filter counts go to a JSON file together with the subreddit counts, which are
+    also written to a Parquet table (subreddit, count, kept_count) so they can be aggregated across files.
+    """
+    stats = {
+        'totals': totals,
+        'filtered_counts': filtered_counts,
+        'subreddit_counts': subreddit_counts,
+        'filtered_subreddit_counts': filtered_subreddit_counts,
+    }
+    with open(stats_output_file, 'w', encoding='utf-8') as stats_file:
+        json.dump(stats, stats_file, indent=2, ensure_ascii=False)
 
-    return header_written
+    counts_table = pa.table({
+        'subreddit': pa.array(list(subreddit_counts), type=pa.string()),
+        'count': pa.array(list(subreddit_counts.values()), type=pa.int64()),
+        'kept_count': pa.array([filtered_subreddit_counts.get(subreddit, 0) for subreddit in subreddit_counts],
+                               type=pa.int64()),
+    })
+    pq.write_table(counts_table, counts_output_file, compression=PARQUET_COMPRESSION)